@@ -1,22 +1,64 @@
-from datetime import datetime
-import io
-import uuid
-from typing import List, Optional, Dict
-
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import mmap
+import queue
+import secrets
+import sys
+from time import gmtime, monotonic, strftime
+from typing import BinaryIO, Iterator, List, Optional, Dict, Tuple, Union
+
+import cv2
 import numpy as np
+import simplejpeg
 from fastapi import FastAPI, File, Form, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from PIL import Image
 
 # quality gates & helpers (blur/lighting + quick ready-check)
 from quality_gates import (
     evaluate_basic_gates,       # returns ready, failing_gates, guidance, diagnostics
-    calc_blur_laplacian_var,    # per-frame sharpness metric
-    calc_hist_clip_pct,         # per-frame lighting clipping %
+    calc_gates_fused,           # per-frame (sharpness, lighting clipping %)
+    BLUR_DROP_VAR,              # hard per-frame drop limits for bursts
+    CLIP_DROP_PCT,
 )
 
-app = FastAPI(title="PD Prototype API (local)")
+# While the app runs, handlers only enqueue records and the stdout write
+# happens on the listener's background thread, so request handlers never
+# block on console I/O. Outside lifespan (e.g. `--lifespan off`) nothing would
+# drain the queue, so the logger writes to stdout directly instead.
+logger = logging.getLogger("pd")
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_queue_handler = QueueHandler(_log_queue)
+_log_listener = QueueListener(_log_queue, _log_stream)
+logger.addHandler(_log_stream)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _log_listener.start()
+    logger.addHandler(_log_queue_handler)
+    logger.removeHandler(_log_stream)
+    try:
+        yield
+    finally:
+        logger.addHandler(_log_stream)
+        logger.removeHandler(_log_queue_handler)
+        _log_listener.stop()   # flushes anything still queued
+
+# orjson encodes the float lists in diagnostics much faster than stdlib json
+app = FastAPI(
+    title="PD Prototype API (local)",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 # Allow Vite dev server origins
 app.add_middleware(
@@ -34,59 +76,160 @@ app.add_middleware(
 
 @app.get("/healthz")
 def health():
-    return {"ok": True, "server_time": datetime.utcnow().isoformat() + "Z"}
+    # Second resolution is plenty for a probe and skips datetime construction
+    return {"ok": True, "server_time": strftime("%Y-%m-%dT%H:%M:%SZ", gmtime())}
+
+# -------------------- Frame decoding --------------------
+
+MAX_FRAME_W = 960        # downscale wider uploads before running gates
+JPEG_SOI = b"\xff\xd8"   # start-of-image marker every JPEG begins with
+
+def _decode_gray(fp: BinaryIO) -> np.ndarray:
+    """
+    Decode an uploaded frame into an 8-bit grayscale array, downscaled to
+    MAX_FRAME_W. JPEGs (i.e. every camera frame) go through libjpeg-turbo
+    directly; anything else, or a JPEG it rejects, falls back to PIL.
+    """
+    if fp.read(2) == JPEG_SOI:
+        try:
+            with _upload_buffer(fp) as buf:
+                return _fit_width(_decode_gray_jpeg(buf))
+        except ValueError:
+            pass  # e.g. CMYK JPEGs; PIL copes with those
+    fp.seek(0)
+    return _fit_width(_decode_gray_pil(fp))
+
+@contextmanager
+def _upload_buffer(fp: BinaryIO) -> Iterator[Union[bytes, mmap.mmap]]:
+    """
+    Bytes-like view of a spooled upload for decoders that need a buffer.
+    Uploads Starlette has rolled to disk (> 1 MB) are mmapped rather than
+    copied; in-memory ones are at most 1 MB, so reading them is cheap.
+    """
+    if getattr(fp, "_rolled", True):   # same check as UploadFile._in_memory
+        try:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # no real fd, or an empty file
+            mm = None
+        if mm is not None:
+            with mm:
+                yield mm
+            return
+    fp.seek(0)
+    yield fp.read()
+
+def _decode_gray_jpeg(buf: Union[bytes, mmap.mmap]) -> np.ndarray:
+    """
+    Fast path: simplejpeg hands back a gray ndarray in one call, using the
+    fast integer DCT and scaling by 1/8 steps during the IDCT while staying
+    at least MAX_FRAME_W wide. What is left to resize is under 2x.
+    Gray output means libjpeg-turbo only inverse-transforms the Y plane;
+    chroma is never decoded. The widget's 1280x720 frames scale by 6/8 to
+    exactly 960x540, so they skip the resize too.
+    """
+    gray = simplejpeg.decode_jpeg(buf, colorspace="GRAY", fastdct=True, min_width=MAX_FRAME_W)
+    return gray[:, :, 0]  # (H, W, 1) -> (H, W), still contiguous
+
+def _decode_gray_pil(fp: BinaryIO) -> np.ndarray:
+    """
+    Generic path. PIL reads `fp` in place and np.asarray reads its array
+    interface directly, so there is no extra ndarray copy or channel swap.
+    """
+    pil = Image.open(fp)
+
+    # For JPEGs, let libjpeg decode straight to gray and scale by 1/2..1/8
+    # during the IDCT; the result stays at least MAX_FRAME_W wide.
+    if pil.width > MAX_FRAME_W:
+        pil.draft("L", (MAX_FRAME_W, pil.height * MAX_FRAME_W // pil.width))
+
+    # Every gate works on luminance only, so decode straight to 8-bit gray
+    if pil.mode != "L":
+        pil = pil.convert("L")
+
+    return np.asarray(pil)
+
+def _fit_width(gray: np.ndarray) -> np.ndarray:
+    """
+    The one resize policy for every decode path: frames wider than
+    MAX_FRAME_W are area-averaged down to exactly that width, so the
+    scale-sensitive blur gate never depends on the upload format.
+    """
+    if gray.shape[1] <= MAX_FRAME_W:
+        return gray
+    h = int(gray.shape[0] * (MAX_FRAME_W / gray.shape[1]))
+    return cv2.resize(gray, (MAX_FRAME_W, h), interpolation=cv2.INTER_AREA)
+
+def _process_frame(fp: BinaryIO) -> Tuple[float, float]:
+    """Decode one burst frame and return its (blur, clip_pct) metrics."""
+    gray = _decode_gray(fp)
+    return calc_gates_fused(gray)
 
 # -------------------- Ready-check (still useful for debugging) --------------------
 
+def _check_frame(fp: BinaryIO) -> Tuple[bool, List[str], str, Dict[str, float]]:
+    """Decode one frame and run the ready-check gates on it."""
+    return evaluate_basic_gates(_decode_gray(fp))
+
 class ReadyCheckResponse(BaseModel):
     ready: bool
     failing_gates: List[str]
     guidance: str
     action: Optional[str]
     server_token: str
-    diagnostics: Dict[str, float]  # {"blur_laplacian_var": float, "lighting_clip_pct": float}
-
-@app.post("/v1/measurements/ready-check", response_model=ReadyCheckResponse)
+    diagnostics: Dict[str, Optional[float]]  # {"blur_laplacian_var": float|null, "lighting_clip_pct": float}
+
+# Response models document the schema only: handlers return ORJSONResponse
+# directly, which skips FastAPI's per-field output validation/encoding
+@app.post(
+    "/v1/measurements/ready-check",
+    response_model=None,
+    responses={200: {"model": ReadyCheckResponse}},
+)
 async def ready_check(frame: UploadFile = File(...), meta: Optional[str] = Form(None)):
     """
     Fast single-frame gates (sharpness + lighting). Returns a server_token that
     you *can* send to /measure, but in Hybrid mode the client may skip this
     and call /measure directly.
     """
-    raw = await frame.read()
-    pil = Image.open(io.BytesIO(raw)).convert("RGB")
-
-    # Optional downscale for speed
-    max_w = 960
-    if pil.width > max_w:
-        h = int(pil.height * (max_w / pil.width))
-        pil = pil.resize((max_w, h))
-
-    rgb = np.array(pil)
-    bgr = rgb[:, :, ::-1].copy()
-
-    ready, failing, guidance, metrics = evaluate_basic_gates(bgr)
+    # Off the event loop: uploads past 1 MB are read from disk, then decoded
+    ready, failing, guidance, metrics = await run_in_threadpool(_check_frame, frame.file)
     action = None
-    token = str(uuid.uuid4())
+    token = secrets.token_urlsafe(12)   # opaque id; no UUID formatting needed
 
-    print(f"[ready-check] blur={metrics['blur_laplacian_var']:.1f} "
-          f"clip={metrics['lighting_clip_pct']:.1f}% ready={ready} gates={failing}")
+    logger.info("[ready-check] blur=%.1f clip=%.1f%% ready=%s gates=%s",
+                metrics["blur_laplacian_var"], metrics["lighting_clip_pct"], ready, failing)
 
-    return ReadyCheckResponse(
-        ready=ready,
-        failing_gates=failing,
-        guidance=guidance,
-        action=action,
-        server_token=token,
-        diagnostics=metrics,
-    )
+    return ORJSONResponse({
+        "ready": ready,
+        "failing_gates": failing,
+        "guidance": guidance,
+        "action": action,
+        "server_token": token,
+        "diagnostics": metrics,
+    })
 
 # -------------------- Measure (Hybrid-friendly) --------------------
 
 USAGE_COUNTER = {"measure_calls": 0}
-RECENT_TOKENS: Dict[str, float] = {}   # token -> last_used_timestamp (epoch seconds)
+# token -> last_used_timestamp (monotonic seconds), oldest first
+RECENT_TOKENS: "OrderedDict[str, float]" = OrderedDict()
+RECENT_TOKENS_MAX = 4096               # hard cap in case of a flood of fresh tokens
 TOKEN_COOLDOWN_SEC = 2.5               # avoid rapid duplicate bursts per token
 
+# Scoring policy: linear ramps between break points, clamped to 0..1
+BLUR_SCORE_RAMP = (40.0, 160.0)   # blur component: 0 at 40 → 1 at 160 (adjust for your cameras later)
+CLIP_SCORE_RAMP = (4.0, 16.0)     # clip component: 1 at 4% → 0 at 16%
+SCORE_BANDS = (0.55, 0.75)        # score → message band thresholds
+SCORE_MESSAGES = ("Low quality — retake", "Borderline — consider retaking", "OK")
+
+def score_component_blur(b: float) -> float:
+    lo, hi = BLUR_SCORE_RAMP
+    return min(max((b - lo) / (hi - lo), 0.0), 1.0)
+
+def score_component_clip(c: float) -> float:
+    lo, hi = CLIP_SCORE_RAMP
+    return min(max((hi - c) / (hi - lo), 0.0), 1.0)
+
 class MeasureResponse(BaseModel):
     ok: bool
     distance_pd_mm: Optional[float]   # placeholder; real value in next step
@@ -96,7 +239,11 @@ class MeasureResponse(BaseModel):
     diagnostics: Dict[str, List[float]]  # {"blur": [...], "clip_pct": [...]}
     message: str
 
-@app.post("/v1/measurements/measure", response_model=MeasureResponse)
+@app.post(
+    "/v1/measurements/measure",
+    response_model=None,
+    responses={200: {"model": MeasureResponse}},
+)
 async def measure(
     server_token: Optional[str] = Form(None),        # <-- optional in Hybrid
     working_distance_cm: Optional[float] = Form(40.0),
@@ -107,105 +254,83 @@ async def measure(
     quality score using per-frame sharpness (Laplacian variance) and lighting
     clipping. Distance/Near PD will be added next when we wire landmarks.
     """
-    from time import time
-    now = time()
+    now = monotonic()
     USAGE_COUNTER["measure_calls"] += 1
 
     # If client supplies the token from ready-check, enforce a small cooldown
     if server_token:
-        last = RECENT_TOKENS.get(server_token, 0.0)
-        if now - last < TOKEN_COOLDOWN_SEC:
-            return MeasureResponse(
-                ok=False,
-                distance_pd_mm=None,
-                near_pd_mm=None,
-                score=0.0,
-                frames_used=0,
-                diagnostics={"blur": [], "clip_pct": []},
-                message="Too-rapid repeat; please hold still briefly.",
-            )
+        # Entries are in last-used order, so expired ones are all at the front;
+        # anything still present after the sweep is within its cooldown
+        while RECENT_TOKENS and now - next(iter(RECENT_TOKENS.values())) >= TOKEN_COOLDOWN_SEC:
+            RECENT_TOKENS.popitem(last=False)
+
+        if server_token in RECENT_TOKENS:
+            return ORJSONResponse({
+                "ok": False,
+                "distance_pd_mm": None,
+                "near_pd_mm": None,
+                "score": 0.0,
+                "frames_used": 0,
+                "diagnostics": {"blur": [], "clip_pct": []},
+                "message": "Too-rapid repeat; please hold still briefly.",
+            })
         RECENT_TOKENS[server_token] = now
-
-    blur_vals: List[float] = []
-    clip_vals: List[float] = []
-
-    for f in frames:
-        raw = await f.read()
-        pil = Image.open(io.BytesIO(raw)).convert("RGB")
-
-        # Keep processing snappy
-        max_w = 960
-        if pil.width > max_w:
-            h = int(pil.height * (max_w / pil.width))
-            pil = pil.resize((max_w, h))
-
-        rgb = np.array(pil)
-        bgr = rgb[:, :, ::-1].copy()
-
-        b = calc_blur_laplacian_var(bgr)
-        c = calc_hist_clip_pct(bgr)
-
-        # Drop obviously broken frames (camera hiccups, exposure spikes)
-        if b < 5.0 or c > 50.0:
-            continue
-
-        blur_vals.append(b)
-        clip_vals.append(c)
-
-    frames_used = len(blur_vals)
+        if len(RECENT_TOKENS) > RECENT_TOKENS_MAX:
+            RECENT_TOKENS.popitem(last=False)
+
+    # Decode + gates per frame run on the threadpool; libjpeg-turbo/PIL decode
+    # and the Numba gate kernel (nogil) release the GIL, so a burst is
+    # processed in parallel instead of on the event loop.
+    # Each worker decodes from the upload's spooled temp file: in memory up to
+    # 1 MB, mmapped from disk beyond that, so no frame is copied in full.
+    results = await asyncio.gather(*(run_in_threadpool(_process_frame, f.file) for f in frames))
+
+    # One (N, 2) row-per-frame array of (blur, clip_pct), filtered with a mask.
+    # Drop obviously broken frames (camera hiccups, exposure spikes); a NaN
+    # blur (clip gate already failed) compares False and is dropped too.
+    per_frame = np.array(results, dtype=np.float64).reshape(-1, 2)
+    keep = (per_frame[:, 1] <= CLIP_DROP_PCT) & (per_frame[:, 0] >= BLUR_DROP_VAR)
+    kept = per_frame[keep]
+    blur_vals = kept[:, 0].tolist()
+    clip_vals = kept[:, 1].tolist()
+
+    frames_used = len(kept)
     if frames_used < 3:
-        return MeasureResponse(
-            ok=False,
-            distance_pd_mm=None,
-            near_pd_mm=None,
-            score=0.0,
-            frames_used=frames_used,
-            diagnostics={"blur": blur_vals, "clip_pct": clip_vals},
-            message="Low-quality burst — retake",
-        )
+        return ORJSONResponse({
+            "ok": False,
+            "distance_pd_mm": None,
+            "near_pd_mm": None,
+            "score": 0.0,
+            "frames_used": frames_used,
+            "diagnostics": {"blur": blur_vals, "clip_pct": clip_vals},
+            "message": "Low-quality burst — retake",
+        })
 
     # ----- Prototype quality score (0..1) -----
-    # Median for robustness against outliers in a burst
-    import statistics as stats
-    med_blur = stats.median(blur_vals)
-    med_clip = stats.median(clip_vals)
-
-    # Blur component: 0 at 40 → 1 at 160 (adjust for your cameras later)
-    def score_component_blur(b: float) -> float:
-        if b >= 160.0: return 1.0
-        if b <= 40.0:  return 0.0
-        return (b - 40.0) / (160.0 - 40.0)
-
-    # Clip component: 1 at 4% → 0 at 16%
-    def score_component_clip(c: float) -> float:
-        if c <= 4.0:  return 1.0
-        if c >= 16.0: return 0.0
-        return 1.0 - (c - 4.0) / (16.0 - 4.0)
+    # Median for robustness against outliers in a burst; np.median selects
+    # via partitioning instead of sorting a Python list per metric
+    med_blur, med_clip = (float(m) for m in np.median(kept, axis=0))
 
     s_blur = score_component_blur(med_blur)
     s_clip = score_component_clip(med_clip)
     score = round(0.7 * s_blur + 0.3 * s_clip, 3)
 
-    # Score → message banding
-    message = (
-        "OK" if score >= 0.75
-        else "Borderline — consider retaking" if score >= 0.55
-        else "Low quality — retake"
-    )
+    # Score → message banding: index = number of band thresholds reached
+    message = SCORE_MESSAGES[(score >= SCORE_BANDS[0]) + (score >= SCORE_BANDS[1])]
 
-    print(f"[measure] frames={frames_used} med_blur={med_blur:.1f} "
-          f"med_clip={med_clip:.1f}% score={score:.2f} token={server_token or '-'}")
+    logger.info("[measure] frames=%d med_blur=%.1f med_clip=%.1f%% score=%.2f token=%s",
+                frames_used, med_blur, med_clip, score, server_token or "-")
 
     # Distance/Near PD will be computed next (landmarks-based)
-    return MeasureResponse(
-        ok=True,
-        distance_pd_mm=None,
-        near_pd_mm=None,
-        score=score,
-        frames_used=frames_used,
-        diagnostics={"blur": blur_vals, "clip_pct": clip_vals},
-        message=message,
-    )
+    return ORJSONResponse({
+        "ok": True,
+        "distance_pd_mm": None,
+        "near_pd_mm": None,
+        "score": score,
+        "frames_used": frames_used,
+        "diagnostics": {"blur": blur_vals, "clip_pct": clip_vals},
+        "message": message,
+    })
 
 # -------------------- Admin: usage counter --------------------
 
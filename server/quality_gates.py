@@ -1,38 +1,99 @@
 from typing import Tuple, List, Dict
 import numpy as np
-import cv2
+from numba import njit
 
-def calc_blur_laplacian_var(bgr: np.ndarray) -> float:
+# Hard per-frame drop limits: frames past these are camera hiccups or exposure
+# spikes, not just low quality. Clip% is far cheaper than the Laplacian, so it
+# is checked first and blur is skipped (reported as NaN) for dropped frames.
+BLUR_DROP_VAR = 5.0
+CLIP_DROP_PCT = 50.0
+
+@njit(inline="always")
+def _reflect101(i: int, n: int) -> int:
+    """Border index as in cv2.BORDER_REFLECT_101 (cv2.Laplacian's default)."""
+    if n == 1:
+        return 0
+    if i < 0:
+        return -i
+    if i >= n:
+        return 2 * n - 2 - i
+    return i
+
+@njit(inline="always")
+def _lap_at(row: np.ndarray, up: np.ndarray, dn: np.ndarray, x: int, xm: int, xp: int) -> int:
+    """4-neighbour Laplacian stencil, i.e. cv2.Laplacian(ksize=1), at one pixel."""
+    return (np.int64(row[xm]) + np.int64(row[xp]) + np.int64(up[x]) + np.int64(dn[x])
+            - 4 * np.int64(row[x]))
+
+@njit(cache=True, fastmath=True, boundscheck=False, nogil=True)
+def _fused_gates_kernel(gray: np.ndarray, clip_limit: float) -> Tuple[float, float]:
     """
-    Sharpness metric: variance of Laplacian on grayscale image.
-    Laptop/phone webcams can be *very* smooth; values of 60–250 are common.
+    Variance of cv2.Laplacian(ksize=1) plus the 0/255 pixel percentage in
+    one tight loop: no temporaries, Laplacian moments kept as int64 sums.
+    Returns blur = -1.0 without running the stencil if clip% > clip_limit.
     """
-    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
-    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+    h, w = gray.shape
+    n = h * w
+    if n == 0:
+        return 0.0, 0.0
+
+    extreme = 0
+    for y in range(h):
+        for x in range(w):
+            v = gray[y, x]
+            if v == 0 or v == 255:
+                extreme += 1
+
+    clip = extreme * 100.0 / n
+    if clip > clip_limit:
+        return -1.0, clip
+
+    s = 0
+    ss = 0
+    for y in range(h):
+        row = gray[y]
+        up = gray[_reflect101(y - 1, h)]
+        dn = gray[_reflect101(y + 1, h)]
+        # Interior columns: branch-free so LLVM can vectorize
+        for x in range(1, w - 1):
+            lap = _lap_at(row, up, dn, x, x - 1, x + 1)
+            s += lap
+            ss += lap * lap
+        # First and last column (just the first when w == 1)
+        for x in range(0, w, max(w - 1, 1)):
+            lap = _lap_at(row, up, dn, x, _reflect101(x - 1, w), _reflect101(x + 1, w))
+            s += lap
+            ss += lap * lap
+
+    mean = s / n
+    return max(ss / n - mean * mean, 0.0), clip
 
-def calc_hist_clip_pct(bgr: np.ndarray) -> float:
+def calc_gates_fused(gray: np.ndarray, clip_limit: float = CLIP_DROP_PCT) -> Tuple[float, float]:
     """
-    Lighting check: % of pixels at 0 or 255 (pure black/white).
-    Lower is better; high values mean crushed shadows/highlights or backlight.
+    Both per-frame metrics in one go: (blur_laplacian_var, clip_pct).
+      - sharpness: variance of the Laplacian on the 8-bit gray frame, same
+        stencil and borders as cv2.Laplacian. Laptop/phone webcams can be
+        *very* smooth; values of 60–250 are common.
+      - lighting: % of pixels at 0 or 255 (pure black/white). Lower is better;
+        high values mean crushed shadows/highlights or backlight.
+    Runs as a single Numba-compiled loop over `gray`.
+    Blur is NaN when clip_pct > clip_limit, since the frame is dropped anyway.
     """
-    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
-    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).flatten()
-    total = hist.sum() if hist.sum() > 0 else 1.0
-    extreme = hist[0] + hist[-1]
-    return float((extreme / total) * 100.0)
+    blur, clip = _fused_gates_kernel(gray, clip_limit)
+    return (float(blur) if blur >= 0.0 else float("nan")), float(clip)
 
-def evaluate_basic_gates(bgr: np.ndarray) -> Tuple[bool, List[str], str, Dict[str, float]]:
+def evaluate_basic_gates(gray: np.ndarray) -> Tuple[bool, List[str], str, Dict[str, float]]:
     """
     Minimal, fast gates for Step 6 with diagnostics.
       - sharpness via Laplacian variance (>= 80 for now)
       - lighting via histogram clipping (< 8% for now)
     Returns: (ready, failing_gates, guidance, metrics)
+    Frames past CLIP_DROP_PCT only fail "lighting"; their blur metric is NaN.
     """
     failing: List[str] = []
     guidance = "Hold still… capturing soon"
 
-    blur = calc_blur_laplacian_var(bgr)
-    clip = calc_hist_clip_pct(bgr)
+    blur, clip = calc_gates_fused(gray)
 
     # Relaxed thresholds to validate pipeline; we’ll tighten later.
     if blur < 80.0: